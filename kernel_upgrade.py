@@ -1,21 +1,39 @@
 #!/usr/bin/env python3
 
-import bs4
+import concurrent.futures
 import dotenv
+import email.utils
+import functools
+import hashlib
+import json
 import logging
 import logging.config
+import lxml.html
 import os
 import pathlib
+import re
 import requests
+import select
+import shutil
 import signal
 import subprocess
 import sys
 import time
+import urllib3
 import yaml
 
 
 # Global vars
 PRERUN_SAFETY_TIME = 5  # time to sleep before running
+DOWNLOAD_WORKERS = 4  # number of .deb files to download at once
+RANGE_WORKERS = 4  # connections used to split up the Linux Image download
+CHUNK_SIZE = 256 * 1024  # bytes per download chunk / file write buffer
+HASH_BLOCK_SIZE = 1 << 20  # bytes read at a time when checksumming a .deb
+CACHE_DIR = pathlib.Path.home() / '.cache' / 'kernel_upgrader'
+CACHE_TTL = 3600  # seconds before a cached page result is checked again
+REQUEST_TIMEOUT = 10  # seconds to wait to connect, or between bytes of a response
+LATEST_RE = re.compile(rb'id="latest_link"[^>]*>\s*(?:<a[^>]*>\s*)?([0-9.]+)')
+USER_AGENT = 'kernel_upgrader (+https://github.com/idwpan/kernel_upgrader)'
 
 ENV_PATH = pathlib.Path('.') / '.env'
 dotenv.load_dotenv(dotenv_path=ENV_PATH)
@@ -42,10 +60,23 @@ with open('./logging_config.yaml', 'rt') as log_cfg:
 
 
 def safety(seconds=PRERUN_SAFETY_TIME):
-    """Pauses to allow the user to exit before initiating a Kernel upgrade"""
+    """Pauses to allow the user to exit before initiating a Kernel upgrade
+
+    When run from a terminal, pressing Enter ends the pause early.
+
+    """
     logging.warning("If you do not want to upgrade your Kernel, or aren't comfortable using this program, please hit Ctrl+C now.")
     logging.warning(f"Now sleeping for {seconds} seconds.")
-    time.sleep(seconds)
+
+    if not sys.stdin.isatty():
+        time.sleep(seconds)
+        return
+
+    # wait on stdin from this thread, so nothing is left reading it once dpkg runs
+    logging.warning("Press Enter to continue now.")
+    ready, _, _ = select.select([sys.stdin], [], [], seconds)
+    if ready:
+        sys.stdin.readline()
 
 
 def signal_handler(sig, frame):
@@ -58,10 +89,96 @@ def signal_handler(sig, frame):
     sys.exit(0)
 
 
-def soupify(url):
-    """Perform GET request and load into BeautifulSoup"""
-    r = requests.get(url)
-    return bs4.BeautifulSoup(r.text, 'html.parser')
+def make_session():
+    """Creates the HTTP session shared by every request
+
+    Keeping one session means connections are reused, instead of a new
+    TCP + TLS handshake for every page and .deb file.
+
+    Returns:
+        requests.Session
+
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=8)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['User-Agent'] = USER_AGENT
+    return session
+
+
+def fetch_page(session, url, headers=None):
+    """Perform GET request for a page
+
+    Args:
+        session (requests.Session): session to send the request with
+        url (str): page to request
+        (optional) headers (dict): extra request headers
+
+    Returns:
+        bytes: page content, or None if the server replied 304 Not Modified
+
+    Raises:
+        requests.HTTPError: on a 4xx/5xx response, so error pages never get cached
+
+    """
+    r = session.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+    if r.status_code == 304:
+        return None
+    r.raise_for_status()
+    return r.content
+
+
+def cached_page(session, url, extract, ttl=CACHE_TTL):
+    """Returns the data extracted from a page, using a JSON cache on disk
+
+    Results younger than ttl are returned without touching the network.
+    Older ones are revalidated with If-Modified-Since, so an unchanged page
+    is neither downloaded nor parsed again.
+
+    Args:
+        session (requests.Session): session to send the request with
+        url (str): page to request
+        extract (callable): takes the page content (bytes), returns JSON-serializable data
+        (optional) ttl (int): seconds a cached result is trusted without asking
+
+    Returns:
+        the value returned by extract()
+
+    """
+    path = CACHE_DIR / f"{hashlib.sha256(url.encode()).hexdigest()}.json"
+    headers = {}
+
+    if path.exists():
+        try:
+            mtime = path.stat().st_mtime
+            cached = json.loads(path.read_text())
+        except (OSError, ValueError) as e:
+            # a corrupt or unreadable cache file is just a cache miss
+            logging.debug(f"Ignoring cache file {path}: {e}")
+        else:
+            if mtime + ttl > time.time():
+                logging.debug(f"Using cached result for {url}")
+                return cached
+            headers['If-Modified-Since'] = email.utils.formatdate(mtime, usegmt=True)
+
+    # a 304 only comes back if If-Modified-Since was sent, so cached is set
+    content = fetch_page(session, url, headers=headers)
+    if content is None:
+        logging.debug(f"Not modified, reusing cached result for {url}")
+        try:
+            path.touch()
+        except OSError as e:
+            logging.debug(f"Could not refresh cache file {path}: {e}")
+        return cached
+
+    data = extract(content)
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(data))
+    except OSError as e:
+        logging.debug(f"Could not write cache file {path}: {e}")
+    return data
 
 
 class Kernel:
@@ -69,6 +186,7 @@ class Kernel:
 
     Params:
         URL (str): URL to kernel.org
+        session (requests.Session): HTTP session shared by all requests
         major (int): Linux "major" version part. (ie: {5}.1.6)
         minor (int): Linux "minor" version part. (ie: 5.{1}.6)
         revision (int): Linux "revision" version part. (ie: 5.1.{6})
@@ -78,6 +196,7 @@ class Kernel:
     """
     def __init__(self):
         self.URL = "https://kernel.org/"
+        self.session = make_session()
         self._update()
 
     def _update(self):
@@ -94,10 +213,24 @@ class Kernel:
             tuple: (major, minor, revision)
 
         """
-        soup = soupify(self.URL)
-        kernel_ver = soup.find("td", {"id": "latest_link"}).getText().strip().split('.')
+        kernel_ver = cached_page(self.session, self.URL, self._parse_latest)
         return tuple(kernel_ver)
 
+    @staticmethod
+    def _parse_latest(content):
+        """Pulls the version out of td#latest_link on the kernel.org front page
+
+        A regex is plenty for one tag, and far cheaper than building a tree.
+
+        Args:
+            content (bytes): kernel.org page
+
+        Returns:
+            list: [major, minor, revision]
+
+        """
+        return LATEST_RE.search(content).group(1).decode().split('.')
+
     def get_latest_ver(self):
         """Displays latest version string.
 
@@ -113,17 +246,18 @@ class Upgrade(Kernel):
 
     Child-class to Kernel() so only one object needs to be initialized to
     begin the upgrade. When Upgrade() is initialized, it runs through the
-    kernel version fetching, and saves to Upgrade().kernel_version
+    kernel version fetching, and saves to Upgrade().kernel_version.
+    Nothing is downloaded or installed until install_all_debs() is called.
 
     """
     def __init__(self):
-        """Fetch kernel version, then list of required .deb files, then install them"""
+        """Fetch kernel version, then list of required .deb files"""
         Kernel.__init__(self)
         self.URL = "https://kernel.ubuntu.com/~kernel-ppa/mainline"
         self.return_codes = [False, False, False, False]
         self.kernel_version = Kernel.get_latest_ver(self)
         self.packages = self.fetch_deb_lst()
-        self.install_all_debs()
+        self.checksums = self.fetch_checksums()
 
 
     def fetch_deb_lst(self, arch="amd64"):
@@ -136,17 +270,12 @@ class Upgrade(Kernel):
             list: of required .deb filenames to install
 
         """
-        out = []
-
-        soup = soupify(f"{self.URL}/v{self.kernel_version}/")
-        tag = soup.find('body').find('code')
-        links = tag.find_all('a', href=True)
+        links = cached_page(self.session, f"{self.URL}/v{self.kernel_version}/",
+                            lambda content: lxml.html.fromstring(content).xpath('//body//code//a[@href]/text()'))
 
-        for ittr, link in enumerate(links):
-            if ((arch in link.text and "BUILD.LOG" not in link.text) or \
-               (arch in links[ittr-1].text and "all" in link.text)) and \
-               ("lowlatency" not in link.text):
-                out.append(link.text)
+        # the arch-independent headers are the only "_all.deb" file
+        suffixes = (f"_{arch}.deb", "_all.deb")
+        out = [link for link in links if link.endswith(suffixes) and "lowlatency" not in link]
         return self._deb_sort(out)
 
 
@@ -167,13 +296,11 @@ class Upgrade(Kernel):
         """
         out = [None, None, None, None]
         for f in files:
-            if "headers" in f and "all" in f:
-                out[0] = f
-            elif "headers" in f and "generic" in f:
-                out[1] = f
-            elif "modules" in f and "generic" in f:
+            if f.startswith("linux-headers-"):
+                out[0 if f.endswith("_all.deb") else 1] = f
+            elif f.startswith("linux-modules-"):
                 out[2] = f
-            elif "image" in f and "generic" in f:
+            elif f.startswith("linux-image-"):
                 out[3] = f
 
         logging.debug("Files queued for installation:")
@@ -181,45 +308,146 @@ class Upgrade(Kernel):
             logging.debug(f"{i+1}. {self._shorten_name(o)}")
         return tuple(out)
 
+    def fetch_checksums(self):
+        """Pulls the CHECKSUMS file published next to the .deb files
+
+        A failed request is not cached, and leaves nothing to verify against,
+        so install_all_debs() will refuse to install rather than trust them.
+
+        Returns:
+            dict: {filename (str): sha256 hex digest (str)}, empty if none were found
+
+        """
+        try:
+            checksums = cached_page(self.session, f"{self.URL}/v{self.kernel_version}/CHECKSUMS", self._parse_checksums)
+        except requests.HTTPError as e:
+            logging.warning(f"Could not fetch CHECKSUMS: {e}")
+            checksums = {}
+        return checksums
+
+    @staticmethod
+    def _parse_checksums(content):
+        """Picks the SHA256 lines out of a CHECKSUMS file
+
+        Lines look like "<digest>  <filename>", with SHA1 and SHA256 sections.
+
+        Args:
+            content (bytes): CHECKSUMS file
+
+        Returns:
+            dict: {filename (str): sha256 hex digest (str)}
+
+        """
+        out = {}
+        for line in content.decode(errors='replace').splitlines():
+            parts = line.split()
+            if len(parts) == 2 and len(parts[0]) == 64:
+                out[parts[1]] = parts[0].lower()
+        return out
+
     def get_deb(self, deb):
-        """Request .deb file via GET request, then write data to a file on disk.
+        """Request .deb file via GET request, write data to a file on disk, then verify it.
+
+        Runs in a download thread, so checksumming one file overlaps with the
+        other downloads and installs.
 
         Args:
             deb (str): .deb filename to download
 
+        Returns:
+            bool: False if the file does not match its published checksum, or has none
+
         """
         logging.debug(f"Download Start - ({self._shorten_name(deb)})...")
         t = time.perf_counter()
-        f = self._get_pkg_data(deb)
-        w = self._write_pkg_data(f)
+        self._get_pkg_data(deb)
         e = time.perf_counter() - t
-        logging.debug(f"Download End - Time elapsed: {e:0.2f} seconds")
+        logging.debug(f"Download End - ({self._shorten_name(deb)}) Time elapsed: {e:0.2f} seconds")
+        return self._verify_deb(deb)
+
+    def _verify_deb(self, filename):
+        """Compares a downloaded file's SHA256 against CHECKSUMS
+
+        Args:
+            filename (str): name of file to check
+
+        Returns:
+            bool: True only if there is a checksum and it matches
+
+        """
+        expected = self.checksums.get(filename)
+        if expected is None:
+            logging.warning(f"!!! No checksum published for {self._shorten_name(filename)}, can not verify it")
+            return False
+
+        sha = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+                sha.update(block)
+
+        if sha.hexdigest() != expected:
+            logging.warning(f"!!! Checksum mismatch for {self._shorten_name(filename)}")
+            logging.debug(f"Expected {expected}, got {sha.hexdigest()}")
+            return False
+        logging.debug(f"Checksum OK for {self._shorten_name(filename)}")
+        return True
 
 
     def install_all_debs(self):
-        """Wrapper to install all .debs required"""
-        for deb in self.packages:
-            self.get_deb(deb)
-            self.install_deb(deb)
+        """Wrapper to install all .debs required
 
+        Downloads are independent so they run concurrently, but dpkg has to
+        install the packages one at a time in the order from _deb_sort().
+        Each package is installed as soon as its own download finishes, while
+        the rest are still downloading. The download futures act as the
+        producer side and this loop as the single, in-order consumer.
 
-    def install_deb(self, deb):
+        """
+        # nothing could pass verification, so don't download anything
+        if not self.checksums:
+            logging.warning("No SHA256 checksums found, the packages can not be verified so nothing will be installed.")
+            return
+
+        ex = concurrent.futures.ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS)
+        downloads = [ex.submit(self.get_deb, deb) for deb in self.packages]
+        try:
+            for idx, deb in enumerate(self.packages):
+                t = time.perf_counter()
+                verified = downloads[idx].result()
+                e = time.perf_counter() - t
+                logging.debug(f"Waited {e:0.2f} seconds for the {self._shorten_name(deb)} download")
+                if not verified:
+                    logging.warning(f"Skipping install of {self._shorten_name(deb)}, the download could not be verified.")
+                    continue
+                self.install_deb(deb, idx)
+        finally:
+            # on Ctrl+C or an error, don't start or wait for the remaining downloads
+            for download in downloads:
+                download.cancel()
+            ex.shutdown(wait=False)
+
+
+    def install_deb(self, deb, idx):
         """Installs .deb file and checks return code
 
         Args:
             deb (str): .deb filename to install
+            idx (int): position of deb in self.packages
         """
         logging.debug(f"Installation Start - ({self._shorten_name(deb)})...")
         t = time.perf_counter()
         rc = self._install_deb(deb)
         e = time.perf_counter() - t
         logging.debug(f"Installation End - Time elapsed: {e:0.2f} seconds")
-        self._rc_check(rc, deb)
+        self._rc_check(rc, deb, idx)
 
 
     def _install_deb(self, filename):
         """Runs the dpkg command to install the .deb file
 
+        Executables are given as absolute paths and close_fds=False, which
+        together let CPython use posix_spawn() instead of fork+exec.
+
         Args:
             filename (str): name of file to install
 
@@ -227,31 +455,32 @@ class Upgrade(Kernel):
             int: return code of dpkg attempt
 
         """
-        command = f"dpkg -i ./{filename}".split()
+        command = [shutil.which('dpkg') or 'dpkg', '-i', f"./{filename}"]
         if SUDO_PASS:
-            p = subprocess.Popen(['sudo', '-S'] + command, stdout=subprocess.PIPE, stdin=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+            p = subprocess.Popen([shutil.which('sudo') or 'sudo', '-S'] + command, stdout=subprocess.PIPE, stdin=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, close_fds=False)
             sudo_prompt = p.communicate(SUDO_PASS + '\n')[1]
             rc = p.poll()
         else:
-            p = subprocess.run(command)
+            p = subprocess.run(command, close_fds=False)
             rc = p.returncode
 
         logging.debug(f"{self._shorten_name(filename)} install return code: {rc}")
         return rc
 
 
-    def _rc_check(self, rc, deb_name):
+    def _rc_check(self, rc, deb_name, idx):
         """Handles logging if dpkg return code is not zero
 
         Args:
             rc (int): return code
             deb_name (str): Name of deb file return code is for
+            idx (int): position of deb_name in self.packages
 
         """
         if rc == 0:
             logging.info(f"Installation Success for {self._shorten_name(deb_name)}")
-            self.return_codes[self.packages.index(deb_name)] = True
-            logging.debug(f"Packages index for {self._shorten_name(deb_name)}: {self.packages.index(deb_name)}")
+            self.return_codes[idx] = True
+            logging.debug(f"Packages index for {self._shorten_name(deb_name)}: {idx}")
             logging.debug(f"RCs: {self.return_codes}")
         else:
             logging.warning("!!! Installation may have failed.")
@@ -260,7 +489,9 @@ class Upgrade(Kernel):
 
 
 
-    def _shorten_name(self, filename):
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def _shorten_name(filename):
         """Strips a lot of the numbers from the file names so it's easier to read.
 
         Args:
@@ -308,30 +539,112 @@ class Upgrade(Kernel):
             return False
 
     def _get_pkg_data(self, filename):
-        """Sends the GET request to download the .deb file contents
+        """Streams the .deb file from the Ubuntu kernel site straight to disk
+
+        The response is copied to the file in chunks as it arrives (the loop
+        runs inside shutil.copyfileobj), so the whole file is never held in
+        memory.
 
         Args:
             filename (str): name of file to request from Ubuntu kernel site
 
-        Returns:
-            tuple: (filename (str), file_content (str)
-
         """
         if self._file_exists(filename):
             self._delete_file(filename)
-        return filename, requests.get(f"{self.URL}/v{self.kernel_version}/{filename}").content
+        url = f"{self.URL}/v{self.kernel_version}/{filename}"
+
+        # the image is by far the largest file, so split it across connections
+        if filename.startswith("linux-image-"):
+            try:
+                size = self._content_length(url)
+                if size:
+                    self._get_pkg_ranges(url, filename, size)
+                    return
+            # raw.stream() raises urllib3 errors directly, requests doesn't wrap them
+            except (RuntimeError, requests.RequestException, urllib3.exceptions.HTTPError) as e:
+                logging.warning(f"Split download of {self._shorten_name(filename)} failed, retrying as a single download.")
+                logging.debug(f"Range download error: {e}")
+
+        with self.session.get(url, stream=True, timeout=REQUEST_TIMEOUT) as r, open(filename, 'wb', buffering=CHUNK_SIZE) as f:
+            r.raw.decode_content = True
+            shutil.copyfileobj(r.raw, f, length=CHUNK_SIZE)
+
+    def _content_length(self, url):
+        """Sends a HEAD request to find the size of a file
+
+        Args:
+            url (str): file to check
+
+        Returns:
+            int: size in bytes, or None if unknown or the server doesn't support Range requests
 
-    def _write_pkg_data(self, fetch_resp):
-        """Writes GET response contents to a file
+        """
+        r = self.session.head(url, allow_redirects=True, timeout=REQUEST_TIMEOUT)
+        if r.headers.get('Accept-Ranges') != 'bytes' or 'Content-Length' not in r.headers:
+            return None
+        return int(r.headers['Content-Length'])
+
+    def _get_pkg_ranges(self, url, filename, size):
+        """Downloads a file in parallel pieces using HTTP Range requests
+
+        The file is preallocated, then each piece is written in place at
+        its own offset, so nothing needs to be joined afterwards.
+
+        Args:
+            url (str): file to download
+            filename (str): name of file to write to
+            size (int): total size of the file in bytes
+
+        """
+        fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            try:
+                os.posix_fallocate(fd, 0, size)
+            except OSError:
+                os.ftruncate(fd, size)
+
+            step = -(-size // RANGE_WORKERS)
+            ranges = [(lo, min(lo + step, size) - 1) for lo in range(0, size, step)]
+            with concurrent.futures.ThreadPoolExecutor(max_workers=RANGE_WORKERS) as ex:
+                list(ex.map(lambda r: self._get_pkg_range(url, fd, *r), ranges))
+        finally:
+            os.close(fd)
+
+    def _get_pkg_range(self, url, fd, lo, hi):
+        """Downloads bytes lo-hi (inclusive) of a file into the same place on disk
+
+        Chunks are read straight off the raw urllib3 stream and written with
+        os.pwrite() at their offset, so workers can share one file descriptor.
 
         Args:
-            fetch_resp (tuple): (filename (str), file_contents (str))
+            url (str): file to download
+            fd (int): descriptor of the preallocated file to write to
+            lo (int): first byte offset
+            hi (int): last byte offset
+
+        Raises:
+            RuntimeError: if the server doesn't return exactly the requested range
 
         """
-        name, resp = fetch_resp
-        with open(name, 'wb') as f:
-            f.write(resp)
-        f.close()
+        # raw bytes are written as-is, so ask for them unencoded
+        headers = {'Range': f"bytes={lo}-{hi}", 'Accept-Encoding': 'identity'}
+        with self.session.get(url, headers=headers, stream=True, timeout=REQUEST_TIMEOUT) as r:
+            if r.status_code != 206:
+                raise RuntimeError(f"Range request for {url} returned HTTP {r.status_code}")
+            content_range = r.headers.get('Content-Range', '')
+            if not content_range.startswith(f"bytes {lo}-{hi}/"):
+                raise RuntimeError(f"Range request for {url} bytes {lo}-{hi} got Content-Range '{content_range}'")
+            offset = lo
+            for chunk in r.raw.stream(CHUNK_SIZE, decode_content=False):
+                view = memoryview(chunk)
+                while view:
+                    written = os.pwrite(fd, view, offset)
+                    view = view[written:]
+                    offset += written
+
+        # a stream that ends early would leave zeroed holes from the preallocation
+        if offset != hi + 1:
+            raise RuntimeError(f"Range request for {url} bytes {lo}-{hi} ended early at byte {offset}")
 
 
 
@@ -341,14 +654,24 @@ def main():
     # set up interrupt handler so ctrl-c is caught
     signal.signal(signal.SIGINT, signal_handler)
 
-    # sleep before upgrade
-    safety()
+    # look up the version and package list while waiting, nothing is installed yet
+    ex = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    lookup = ex.submit(Upgrade)
+    try:
+        # sleep before upgrade
+        safety()
+
+        # upgrade
+        logging.info(f"Begining Kernel upgrade for Ubuntu")
+        start_time = time.perf_counter()
 
-    # upgrade
-    logging.info(f"Begining Kernel upgrade for Ubuntu")
-    start_time = time.perf_counter()
+        u = lookup.result()
+    finally:
+        # don't hold up a Ctrl+C exit waiting on the lookup
+        lookup.cancel()
+        ex.shutdown(wait=False)
 
-    u = Upgrade()
+    u.install_all_debs()
 
     # check return values and determine success/failure
     if all(u.return_codes):